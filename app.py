@@ -1,25 +1,29 @@
-from sklearn.preprocessing import LabelEncoder
+from sklearn.preprocessing import LabelEncoder, OneHotEncoder
 from sklearn.model_selection import train_test_split
-from sklearn.cluster import KMeans
+from sklearn.cluster import MiniBatchKMeans
 import logging
+import warnings
 import streamlit as st
 import pandas as pd
 import numpy as np
+from scipy import sparse
 import joblib
 import shap
 import plotly.express as px
 import folium
 from folium.plugins import HeatMap
 import geopandas
-from shapely.geometry import Point
 from streamlit_folium import st_folium
 from sklearn.metrics import confusion_matrix, roc_curve, auc, classification_report
 from sklearn.ensemble import RandomForestClassifier
-import seaborn as sns
 import matplotlib.pyplot as plt
 import os
+import csv
+import hashlib
+import tempfile
+import threading
+from dataclasses import dataclass
 from datetime import datetime
-from sklearn.utils import resample
 from reportlab.lib.pagesizes import letter
 from reportlab.pdfgen import canvas
 
@@ -33,6 +37,9 @@ MODEL_LAST_TRAINED = "2025-05-20 12:10:00"  # Updated to current time
 # Define save_dir globally
 save_dir = './'
 os.makedirs(save_dir, exist_ok=True)
+model_dir = os.path.join(save_dir, 'models')
+os.makedirs(model_dir, exist_ok=True)
+log_file = os.path.join(save_dir, 'prediction_log.csv')
 
 # Page Setup for Wide Layout
 st.set_page_config(page_title="Insurance Risk Dashboard", page_icon="📊", layout="wide")
@@ -55,6 +62,11 @@ if uploaded_file is None:
 def load_data(path):
     logger.info("Loading data...")
     df = pd.read_csv(path)
+    # Narrower dtypes halve the bytes moved by segmentation, encoding, the forest and SHAP
+    for col in df.select_dtypes(include='float64').columns:
+        df[col] = pd.to_numeric(df[col], downcast='float')
+    for col in df.select_dtypes(include='int64').columns:
+        df[col] = pd.to_numeric(df[col], downcast='integer')
     logger.info("Data loaded successfully")
     return df
 
@@ -65,78 +77,220 @@ except Exception as e:
     logger.error(f"Dataset loading failed: {str(e)}")
     st.stop()
 
-# Data Preprocessing with Dynamic Customer Segmentation
-missing_values = df.isna().sum().sum()
-df['claim_risk'] = (df['claim_amount_SZL'] >= df['claim_amount_SZL'].quantile(0.75)).astype(int)
-df.fillna(df.median(numeric_only=True), inplace=True)
-df.fillna('Unknown', inplace=True)
-
-# Convert date columns to numeric features
+# Data Preprocessing, Segmentation and Training
 date_cols = ['policy_start_date', 'claim_date']
-for col in date_cols:
-    if col in df.columns:
-        df[col] = pd.to_datetime(df[col])
-        df[f'{col}_year'] = df[col].dt.year
-        df[f'{col}_month'] = df[col].dt.month
-        df[f'{col}_day'] = df[col].dt.day
-        df = df.drop(columns=[col])
-
-# Dynamic Customer Segmentation using K-means
-numeric_cols = df.select_dtypes(include=['int64', 'float64']).columns
-X_segment = df[numeric_cols].drop(columns=['claim_risk'], errors='ignore')
-kmeans = KMeans(n_clusters=4, random_state=42)
-df['customer_segment'] = kmeans.fit_predict(X_segment).astype(str)
-categorical_cols = ['claim_type', 'gender', 'location', 'policy_type', 'insurance_provider', 'customer_segment']
-for col in df.columns:
-    if df[col].dtype == 'object' and col not in date_cols and col not in ['claim_amount_SZL', 'claim_risk']:
-        if col not in categorical_cols:
-            categorical_cols.append(col)
-df_encoded = pd.get_dummies(df, columns=categorical_cols, drop_first=False)
-
-# Split features and target with balancing
-X = df_encoded.drop(columns=['claim_amount_SZL', 'claim_risk'])
-y = df_encoded['claim_risk']
-X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, stratify=y, random_state=42)
-train_data = pd.concat([X_train, y_train], axis=1)
-majority = train_data[train_data.claim_risk == 0]
-minority = train_data[train_data.claim_risk == 1]
-minority_oversampled = resample(minority, replace=True, n_samples=len(majority), random_state=42)
-train_data_balanced = pd.concat([majority, minority_oversampled])
-X_train_balanced = train_data_balanced.drop(columns=['claim_risk'])
-y_train_balanced = train_data_balanced['claim_risk']
-
-# Train Random Forest Model
-rf = RandomForestClassifier(
-    n_estimators=300,
-    class_weight={0: 1.0, 1: 2.5},
-    max_depth=15,
-    min_samples_leaf=5,
-    random_state=42
-)
-rf.fit(X_train_balanced, y_train_balanced)
-y_pred_rf = rf.predict(X_test)
-logger.info("Random Forest model trained and evaluated.")
 
-# Model Metrics
-report = classification_report(y_test, y_pred_rf, output_dict=True)
-recall_class_1 = report['1']['recall']
-fpr, tpr, _ = roc_curve(y_test, rf.predict_proba(X_test)[:, 1])
-roc_auc = auc(fpr, tpr)
-if recall_class_1 > 0.39:
-    joblib.dump(rf, '/content/rf_model.pkl')
-    logger.info(f"Model saved. Recall for class 1: {recall_class_1}")
-else:
-    logger.info(f"Model not saved. Recall for class 1: {recall_class_1} (below 0.39 threshold)")
-
-# KPI Cards
-st.header("Key Performance Indicators")
-kpi1, kpi2, kpi3, kpi4 = st.columns(4)
-total_policies = len(df)
-high_risk_percent = (df['claim_risk'].mean() * 100)
-kpi1.metric("Total Policies", total_policies)
-kpi2.metric("% High-Risk Policies", f"{high_risk_percent:.1f}%")
-kpi3.metric("Model AUC", f"{roc_auc:.2f}")
-kpi4.metric("Missing Values Imputed", missing_values)
+@dataclass
+class ModelBundle:
+    df: pd.DataFrame
+    categorical_cols: list
+    numeric_features: list
+    ohe: OneHotEncoder
+    missing_values: int
+    rf: RandomForestClassifier
+    X_test: sparse.csr_matrix
+    y_test: np.ndarray
+    test_idx: np.ndarray
+    expected_features: np.ndarray
+
+def encode_features(frame, numeric_features, ohe):
+    # Numeric columns are stacked next to the sparse one-hot block; unseen categories encode to all zeros
+    X_num = sparse.csr_matrix(frame.reindex(columns=numeric_features, fill_value=0).to_numpy(dtype=np.float32))
+    return sparse.hstack([X_num, ohe.transform(frame[ohe.feature_names_in_])], format='csr')
+
+def dump_atomic(obj, path):
+    # Write to a unique temp file next to the target and swap it in, so neither an interrupted dump nor two
+    # processes saving the same model can leave a truncated or interleaved file behind
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            joblib.dump(obj, f)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+def remove_persisted(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def load_persisted(path, expected_type):
+    # Anything unreadable (truncated, or pickled by another scikit-learn/shap version) is discarded and rebuilt
+    if not os.path.exists(path):
+        return None
+    try:
+        obj = joblib.load(path)
+    except Exception as e:
+        logger.warning(f"Discarding unreadable model file {path}: {e}")
+        remove_persisted(path)
+        return None
+    if not isinstance(obj, expected_type):
+        logger.warning(f"Discarding {path}: expected {expected_type.__name__}, got {type(obj).__name__}.")
+        remove_persisted(path)
+        return None
+    return obj
+
+@st.cache_resource(show_spinner="Training model...")
+def build_model(file_hash, _df):
+    df = _df
+    # A single isna() pass gives both the KPI count and the imputation mask; medians are only taken where needed
+    missing_mask = df.isna()
+    missing_values = int(missing_mask.to_numpy().sum())
+    df['claim_risk'] = (df['claim_amount_SZL'] >= df['claim_amount_SZL'].quantile(0.75)).astype(int)
+    fill_cols = missing_mask.columns[missing_mask.any(axis=0).to_numpy()]
+    numeric_fill_cols = [col for col in fill_cols if pd.api.types.is_numeric_dtype(df[col])]
+    if numeric_fill_cols:
+        values = df[numeric_fill_cols].to_numpy()
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            medians = np.nanmedian(values, axis=0)
+        df[numeric_fill_cols] = np.where(missing_mask[numeric_fill_cols].to_numpy(), medians, values)
+        # Entirely empty numeric columns have no median; like the old fillna chain they fall through to 'Unknown'
+        numeric_fill_cols = [col for col, median in zip(numeric_fill_cols, medians) if not np.isnan(median)]
+    other_fill_cols = [col for col in fill_cols if col not in numeric_fill_cols]
+    df[other_fill_cols] = df[other_fill_cols].fillna('Unknown')
+    # Segmentation uses the numeric columns as loaded, not the derived date parts
+    numeric_cols = df.select_dtypes(include='number').columns
+
+    # Convert date columns to numeric features
+    for col in date_cols:
+        if col in df.columns:
+            df[col] = pd.to_datetime(df[col])
+            df[f'{col}_year'] = df[col].dt.year
+            df[f'{col}_month'] = df[col].dt.month
+            df[f'{col}_day'] = df[col].dt.day
+            df = df.drop(columns=[col])
+
+    # Dynamic Customer Segmentation using mini-batch K-means
+    X_segment = df[numeric_cols].drop(columns=['claim_risk'], errors='ignore').to_numpy(dtype=np.float32, copy=False)
+    # fit() already labels every row against the final centres, so no separate predict() pass is needed
+    kmeans = MiniBatchKMeans(n_clusters=4, batch_size=1024, n_init=3, random_state=42).fit(X_segment)
+    df['customer_segment'] = kmeans.labels_.astype(str)
+    categorical_cols = ['claim_type', 'gender', 'location', 'policy_type', 'insurance_provider', 'customer_segment']
+    for col in df.columns:
+        if df[col].dtype == 'object' and col not in date_cols and col not in ['claim_amount_SZL', 'claim_risk']:
+            if col not in categorical_cols:
+                categorical_cols.append(col)
+    numeric_features = [col for col in df.columns if col not in categorical_cols and col not in ['claim_amount_SZL', 'claim_risk']]
+    ohe = OneHotEncoder(handle_unknown='ignore', sparse_output=True, dtype=np.float32).fit(df[categorical_cols])
+    expected_features = np.concatenate([numeric_features, ohe.get_feature_names_out(categorical_cols)])
+
+    # Split features and target with balancing
+    X = encode_features(df, numeric_features, ohe)
+    y = df['claim_risk'].to_numpy()
+    # Split and oversample row indices, then gather each matrix from X in a single pass
+    train_idx, test_idx = train_test_split(np.arange(len(y)), test_size=0.2, stratify=y, random_state=42)
+    idx_majority = train_idx[y[train_idx] == 0]
+    idx_minority = train_idx[y[train_idx] == 1]
+    idx_oversampled = np.random.RandomState(42).choice(idx_minority, size=len(idx_majority), replace=True)
+    idx_balanced = np.concatenate([idx_majority, idx_oversampled])
+    X_train_balanced, y_train_balanced = X[idx_balanced], y[idx_balanced]
+    X_test, y_test = X[test_idx], y[test_idx]
+
+    # Train Random Forest Model, reusing a model persisted for the same dataset
+    rf_path = os.path.join(model_dir, f'rf_{MODEL_VERSION}_{file_hash}.joblib')
+    rf = load_persisted(rf_path, RandomForestClassifier)
+    if rf is not None:
+        if rf.n_features_in_ == len(expected_features):
+            logger.info(f"Random Forest model loaded from {rf_path}.")
+        else:
+            logger.warning(f"Persisted model at {rf_path} expects {rf.n_features_in_} features, got {len(expected_features)}; retraining.")
+            rf = None
+    if rf is None:
+        rf = RandomForestClassifier(
+            n_estimators=300,
+            class_weight={0: 1.0, 1: 2.5},
+            max_depth=15,
+            min_samples_leaf=5,
+            random_state=42,
+            n_jobs=-1
+        )
+        rf.fit(X_train_balanced, y_train_balanced)
+        dump_atomic(rf, rf_path)
+        # An explainer persisted for the previous model no longer matches this one
+        remove_persisted(os.path.join(model_dir, f'explainer_{MODEL_VERSION}_{file_hash}.joblib'))
+        logger.info(f"Random Forest model trained and saved to {rf_path}.")
+    return ModelBundle(
+        df=df,
+        categorical_cols=categorical_cols,
+        numeric_features=numeric_features,
+        ohe=ohe,
+        missing_values=missing_values,
+        rf=rf,
+        X_test=X_test,
+        y_test=y_test,
+        test_idx=test_idx,
+        expected_features=expected_features,
+    )
+
+@st.cache_resource
+def get_explainer(file_hash, _rf):
+    explainer_path = os.path.join(model_dir, f'explainer_{MODEL_VERSION}_{file_hash}.joblib')
+    explainer = load_persisted(explainer_path, shap.TreeExplainer)
+    if explainer is not None:
+        return explainer
+    explainer = shap.TreeExplainer(_rf)
+    dump_atomic(explainer, explainer_path)
+    return explainer
+
+@st.cache_data(show_spinner=False)
+def compute_shap(_explainer, file_hash, X_bytes, shape):
+    # Samples are passed as raw float32 bytes so Streamlit hashes a flat buffer, not a DataFrame
+    X = np.frombuffer(X_bytes, dtype=np.float32).reshape(shape)
+    shap_values = _explainer.shap_values(X)
+    if isinstance(shap_values, list):
+        shap_values = shap_values[1]
+    shap_values = np.asarray(shap_values)
+    if shap_values.ndim == 3:
+        shap_values = shap_values[:, :, 1]
+    return shap_values.reshape(-1, shape[1])
+
+@st.cache_data(show_spinner=False)
+def test_scores(_rf, file_hash, _X_test):
+    # One forest traversal; predict() is the argmax of the same probabilities
+    proba = _rf.predict_proba(_X_test)
+    return _rf.classes_[proba.argmax(axis=1)], proba[:, 1]
+
+# Keyed on the uploaded bytes so widget reruns skip preprocessing and training entirely
+file_hash = hashlib.blake2b(uploaded_file.getvalue(), digest_size=16).hexdigest()
+model = build_model(file_hash, df)
+df = model.df
+categorical_cols = model.categorical_cols
+numeric_features, ohe = model.numeric_features, model.ohe
+missing_values = model.missing_values
+rf = model.rf
+explainer = get_explainer(file_hash, rf)
+X_test, y_test, test_idx = model.X_test, model.y_test, model.test_idx
+expected_features = model.expected_features
+
+# Risk Aggregates
+@st.cache_data(show_spinner=False)
+def risk_aggregates(file_hash, _df):
+    # One bincount pass over the location x segment x claim type cube; every chart's group mean is a marginal of it
+    keys = ['location', 'customer_segment', 'claim_type']
+    codes, levels = zip(*(pd.factorize(_df[key], sort=True) for key in keys))
+    shape = tuple(len(level) for level in levels)
+    flat = np.ravel_multi_index(codes, shape)
+    counts = np.bincount(flat, minlength=np.prod(shape)).reshape(shape)
+    sums = np.bincount(flat, weights=_df['claim_risk'].to_numpy(dtype=np.float64), minlength=np.prod(shape)).reshape(shape)
+
+    def marginal(axes):
+        kept = [i for i in range(len(keys)) if i not in axes]
+        group_sums, group_counts = sums.sum(axis=axes), counts.sum(axis=axes)
+        index = pd.MultiIndex.from_product([levels[i] for i in kept], names=[keys[i] for i in kept])
+        table = pd.DataFrame({
+            'claim_risk': (group_sums / np.maximum(group_counts, 1)).ravel(),
+            'count': group_counts.ravel(),
+        }, index=index)
+        return table[table['count'] > 0].reset_index()
+
+    return {
+        'location': marginal((1, 2)),
+        'claim_type': marginal((0, 1)),
+        'location_segment': marginal((2,)),
+    }
 
 # Map Functions with Segmentations
 def init_map(center=(-26.5, 31.5), zoom_start=7, map_type="cartodbpositron"):
@@ -144,13 +298,12 @@ def init_map(center=(-26.5, 31.5), zoom_start=7, map_type="cartodbpositron"):
 
 def create_point_map(df):
     df[['Latitude', 'Longitude']] = df[['Latitude', 'Longitude']].apply(pd.to_numeric, errors='coerce')
-    df['coordinates'] = df[['Latitude', 'Longitude']].values.tolist()
-    df['coordinates'] = df['coordinates'].apply(Point)
-    df = geopandas.GeoDataFrame(df, geometry='coordinates')
-    df = df.dropna(subset=['Latitude', 'Longitude', 'coordinates'])
-    return df
+    df = df.dropna(subset=['Latitude', 'Longitude'])
+    geometry = geopandas.points_from_xy(df['Longitude'], df['Latitude'])
+    return geopandas.GeoDataFrame(df, geometry=geometry, crs='EPSG:4326')
 
-def plot_from_df(df, folium_map, selected_risk_levels, selected_regions, selected_segments):
+@st.cache_data(show_spinner=False)
+def aggregate_for_map(file_hash, _df):
     region_coords = {
         'Lubombo': (-26.3, 31.8),
         'Hhohho': (-26.0, 31.1),
@@ -158,12 +311,18 @@ def plot_from_df(df, folium_map, selected_risk_levels, selected_regions, selecte
         'Shiselweni': (-27.0, 31.3)
     }
     # Aggregate risk by region and segment
-    risk_by_region_segment = df.groupby(['location', 'customer_segment'])['claim_risk'].mean().reset_index()
+    risk_by_region_segment = risk_aggregates(file_hash, _df)['location_segment']
     risk_by_region_segment = risk_by_region_segment[risk_by_region_segment['location'].isin(region_coords.keys())]
     risk_by_region_segment['Latitude'] = risk_by_region_segment['location'].map(lambda x: region_coords[x][0])
     risk_by_region_segment['Longitude'] = risk_by_region_segment['location'].map(lambda x: region_coords[x][1])
-    risk_by_region_segment['risk_level'] = pd.qcut(risk_by_region_segment['claim_risk'], 3, labels=['Low', 'Medium', 'High'], duplicates='drop')
-
+    # The tertile edges pd.qcut(q=3) computes (up to float rounding when a value sits exactly on an edge);
+    # searchsorted reproduces its right-closed bins
+    tertiles = np.quantile(risk_by_region_segment['claim_risk'], [1/3, 2/3])
+    risk_by_region_segment['risk_level'] = np.array(['Low', 'Medium', 'High'])[np.searchsorted(tertiles, risk_by_region_segment['claim_risk'])]
+    heat_data = _df.loc[_df['claim_risk'] == 1, ['Latitude', 'Longitude']].to_numpy().tolist()
+    return risk_by_region_segment, heat_data
+
+def plot_from_df(risk_by_region_segment, heat_data, folium_map, selected_risk_levels, selected_regions, selected_segments):
     # Apply filters
     if selected_risk_levels:
         risk_by_region_segment = risk_by_region_segment[risk_by_region_segment['risk_level'].isin(selected_risk_levels)]
@@ -179,48 +338,110 @@ def plot_from_df(df, folium_map, selected_risk_levels, selected_regions, selecte
         '2': {'radius': 14, 'color': '#2ca02c'},
         '3': {'radius': 16, 'color': '#d62728'}
     }
-    for i, row in risk_by_region_segment.iterrows():
-        style = segment_styles.get(row['customer_segment'], {'radius': 10, 'color': '#1f77b4'})
+    default_style = {'radius': 10, 'color': '#1f77b4'}
+    styles = risk_by_region_segment['customer_segment'].map(lambda x: segment_styles.get(x, default_style))
+    radii = styles.map(lambda x: x['radius']).tolist()
+    colors = styles.map(lambda x: x['color']).tolist()
+    tooltips = (
+        risk_by_region_segment['location'] + ' (Segment ' + risk_by_region_segment['customer_segment'] + '): '
+        + risk_by_region_segment['risk_level'].astype(str) + ' Risk ('
+        + (risk_by_region_segment['claim_risk'] * 100).map('{:.1f}'.format) + '%)'
+    ).tolist()
+    locations = risk_by_region_segment[['Latitude', 'Longitude']].to_numpy().tolist()
+    for location, radius, color, tooltip in zip(locations, radii, colors, tooltips):
         folium.CircleMarker(
-            location=[row['Latitude'], row['Longitude']],
-            radius=style['radius'],
-            color=style['color'],
+            location=location,
+            radius=radius,
+            color=color,
             fill=True,
-            fill_color=style['color'],
+            fill_color=color,
             fill_opacity=0.7,
-            tooltip=f"{row['location']} (Segment {row['customer_segment']}): {row['risk_level']} Risk ({row['claim_risk']*100:.1f}%)"
+            tooltip=tooltip
         ).add_to(folium_map)
 
     # Add heatmap for high-risk claims
-    heat_data = [[row['Latitude'], row['Longitude']] for _, row in df.iterrows() if row['claim_risk'] == 1]
     HeatMap(heat_data, radius=15).add_to(folium_map)
     return folium_map
 
-@st.cache_data
-def load_map(df, selected_risk_levels, selected_regions, selected_segments):
+def load_map(file_hash, df, selected_risk_levels, selected_regions, selected_segments):
+    # Only the aggregation is cached; building the folium objects from it is cheap
+    risk_by_region_segment, heat_data = aggregate_for_map(file_hash, df)
     m = init_map()
-    m = plot_from_df(df, m, selected_risk_levels, selected_regions, selected_segments)
+    m = plot_from_df(risk_by_region_segment, heat_data, m, selected_risk_levels, selected_regions, selected_segments)
     return m
 
+# Prediction Log, kept open for the life of the server and shared by all sessions
+@dataclass
+class PredictionLog:
+    fh: object
+    writer: object
+    lock: threading.Lock
+
+@st.cache_resource
+def get_prediction_log(log_file):
+    fh = open(log_file, 'a', newline='')
+    writer = csv.writer(fh)
+    if fh.tell() == 0:
+        writer.writerow(['timestamp', 'prediction', 'probability_high_risk'])
+        fh.flush()
+    return PredictionLog(fh=fh, writer=writer, lock=threading.Lock())
+
+# Input widget ranges and options, scanned once per dataset
+@st.cache_data(show_spinner=False)
+def column_stats(file_hash, _df):
+    stats = {}
+    for col in _df.columns:
+        if pd.api.types.is_numeric_dtype(_df[col]):
+            stats[col] = (float(_df[col].min()), float(_df[col].max()), float(_df[col].mean()))
+        else:
+            stats[col] = _df[col].unique()
+    return stats
+
+y_pred_rf, y_proba_rf = test_scores(rf, file_hash, X_test)
+logger.info("Random Forest model evaluated.")
+
+# Model Metrics
+report = classification_report(y_test, y_pred_rf, output_dict=True)
+recall_class_1 = report['1']['recall']
+fpr, tpr, _ = roc_curve(y_test, y_proba_rf)
+roc_auc = auc(fpr, tpr)
+if recall_class_1 > 0.39:
+    logger.info(f"Recall for class 1: {recall_class_1}")
+else:
+    logger.warning(f"Recall for class 1: {recall_class_1} (below 0.39 threshold)")
+
+# KPI Cards
+st.header("Key Performance Indicators")
+kpi1, kpi2, kpi3, kpi4 = st.columns(4)
+total_policies = len(df)
+high_risk_percent = (df['claim_risk'].mean() * 100)
+kpi1.metric("Total Policies", total_policies)
+kpi2.metric("% High-Risk Policies", f"{high_risk_percent:.1f}%")
+kpi3.metric("Model AUC", f"{roc_auc:.2f}")
+kpi4.metric("Missing Values Imputed", missing_values)
+
 # Section 1: Prediction
 col1, col2, col3 = st.columns([2, 1, 1])
 with col1:
     st.header("Predict Claim Risk")
     input_data = {}
+    stats = column_stats(file_hash, df)
     for col in df.columns:
         if col in ['claim_amount_SZL', 'claim_risk'] or col in categorical_cols or col in date_cols:
             continue
+        is_numeric = pd.api.types.is_numeric_dtype(df[col])
         try:
-            if df[col].dtype in ['int64', 'float64']:
-                input_data[col] = st.slider(f"{col}", float(df[col].min()), float(df[col].max()), float(df[col].mean()))
+            if is_numeric:
+                col_min, col_max, col_mean = stats[col]
+                input_data[col] = st.slider(f"{col}", col_min, col_max, col_mean)
             else:
-                input_data[col] = st.selectbox(f"{col}", df[col].unique())
+                input_data[col] = st.selectbox(f"{col}", stats[col])
         except Exception as e:
             st.warning(f"Error with {col}: {str(e)}. Using default value.")
-            input_data[col] = 0 if df[col].dtype in ['int64', 'float64'] else df[col].mode()[0]
+            input_data[col] = 0 if is_numeric else df[col].mode()[0]
 
     for col in categorical_cols:
-        input_data[col] = st.selectbox(f"{col}", df[col].unique())
+        input_data[col] = st.selectbox(f"{col}", stats[col])
 
     for col in date_cols:
         if col in df.columns:
@@ -233,12 +454,7 @@ with col1:
         logger.info("Predict button clicked")
         try:
             input_df = pd.DataFrame([input_data])
-            expected_features = rf.feature_names_in_ if hasattr(rf, 'feature_names_in_') else X_test.columns
-            input_df_encoded = pd.get_dummies(input_df, columns=categorical_cols, drop_first=False)
-            for col in expected_features:
-                if col not in input_df_encoded.columns:
-                    input_df_encoded[col] = 0
-            input_df_encoded = input_df_encoded[expected_features]
+            input_df_encoded = encode_features(input_df, numeric_features, ohe)
             pred = rf.predict(input_df_encoded)[0]
             prob = rf.predict_proba(input_df_encoded)[0][1]
             with col2:
@@ -247,16 +463,10 @@ with col1:
                 st.metric("Probability (High Risk)", f"{prob*100:.1f}%")
                 st.progress(prob)
             logger.info(f"Prediction: {pred}, Probability: {prob}")
-            pred_log = pd.DataFrame({
-                'timestamp': [pd.Timestamp.now()],
-                'prediction': ['High Risk' if pred == 1 else 'Low Risk'],
-                'probability_high_risk': [prob]
-            })
-            log_file = os.path.join(save_dir, 'prediction_log.csv')
-            if os.path.exists(log_file):
-                pred_log.to_csv(log_file, mode='a', header=False, index=False)
-            else:
-                pred_log.to_csv(log_file, index=False)
+            pred_log = get_prediction_log(log_file)
+            with pred_log.lock:
+                pred_log.writer.writerow([pd.Timestamp.now(), 'High Risk' if pred == 1 else 'Low Risk', float(prob)])
+                pred_log.fh.flush()
             logger.info("Prediction saved to prediction_log.csv")
         except Exception as e:
             st.error(f"Prediction failed: {str(e)}")
@@ -267,14 +477,10 @@ col4, col5, col6 = st.columns([1, 1, 1])
 with col4:
     st.header("Model Performance")
     try:
-        y_pred = rf.predict(X_test)
-        cm = confusion_matrix(y_test, y_pred)
-        fig_cm = plt.figure(figsize=(6, 4))
-        sns.heatmap(cm, annot=True, fmt='d', cmap='Blues', xticklabels=['Low Risk', 'High Risk'], yticklabels=['Low Risk', 'High Risk'])
-        plt.xlabel('Predicted')
-        plt.ylabel('Actual')
-        plt.title('Confusion Matrix')
-        st.pyplot(fig_cm)
+        cm = confusion_matrix(y_test, y_pred_rf)
+        fig_cm = px.imshow(cm, text_auto='d', x=['Low Risk', 'High Risk'], y=['Low Risk', 'High Risk'], labels={'x': 'Predicted', 'y': 'Actual', 'color': 'Count'}, color_continuous_scale='Blues', title='Confusion Matrix')
+        fig_cm.update_layout(height=300)
+        st.plotly_chart(fig_cm, use_container_width=True)
         logger.info("Confusion matrix rendered")
     except Exception as e:
         st.error(f"Performance plotting failed: {str(e)}")
@@ -283,7 +489,6 @@ with col4:
 with col5:
     st.header("ROC Curve")
     try:
-        fpr, tpr, _ = roc_curve(y_test, rf.predict_proba(X_test)[:, 1])
         fig_roc = px.line(x=fpr, y=tpr, title=f'ROC Curve (AUC = {roc_auc:.2f})', labels={'x': 'False Positive Rate', 'y': 'True Positive Rate'})
         fig_roc.add_scatter(x=[0, 1], y=[0, 1], mode='lines', line=dict(dash='dash', color='gray'))
         fig_roc.update_layout(height=300)
@@ -297,7 +502,6 @@ with col5:
 with col6:
     st.header("Risk Trend Over Time")
     try:
-        log_file = os.path.join(save_dir, 'prediction_log.csv')
         if os.path.exists(log_file):
             pred_log = pd.read_csv(log_file)
             pred_log['timestamp'] = pd.to_datetime(pred_log['timestamp'])
@@ -312,43 +516,18 @@ with col6:
         logger.error(f"Risk trend plotting failed: {str(e)}")
 
 # Section 3: Feature Importance and Risk Distributions
+risk_tables = risk_aggregates(file_hash, df)
 col7, col8, col9 = st.columns([1, 1, 1])
 with col7:
     st.header("Risk Driver Insights (SHAP)")
-    with st.spinner("Computing SHAP values..."):
-        try:
-            explainer = shap.TreeExplainer(rf)
-            sample_data = X_test.sample(50, random_state=42)
-            sample_encoded = pd.get_dummies(sample_data, columns=[col for col in categorical_cols if col in sample_data.columns], drop_first=False)
-            expected_features = rf.feature_names_in_ if hasattr(rf, 'feature_names_in_') else X_test.columns
-            for col in expected_features:
-                if col not in sample_encoded.columns:
-                    sample_encoded[col] = 0
-            sample_encoded = sample_encoded[expected_features].values
-            shap_values = explainer.shap_values(sample_encoded)
-            if isinstance(shap_values, list):
-                shap_values = shap_values[1]
-            shap_values = np.array(shap_values).reshape(-1, len(expected_features))
-            st.subheader("Features Used in SHAP Analysis")
-            st.write(list(expected_features))
-            fig_shap = plt.figure(figsize=(10, 6))
-            shap.summary_plot(shap_values, sample_encoded, feature_names=expected_features, max_display=5, show=False, plot_type="bar")
-            if plt.gcf().axes:
-                plt.title('Top Features for High Risk')
-                plt.tight_layout()
-                st.pyplot(fig_shap)
-                plt.savefig('shap_plot.png')
-            shap_df = pd.DataFrame({'Feature': expected_features, 'SHAP Value': np.abs(shap_values).mean(axis=0)}).sort_values(by='SHAP Value', ascending=False).head(5)
-            st.session_state['shap_df'] = shap_df
-            logger.info("SHAP plot rendered")
-        except Exception as e:
-            st.error(f"SHAP plot failed: {str(e)}")
-            logger.error(f"SHAP plot failed: {str(e)}")
+    shap_global_slot = st.container()
+    sample_rows = np.random.RandomState(42).choice(X_test.shape[0], min(50, X_test.shape[0]), replace=False)
+    shap_inputs = {'global': X_test[sample_rows].toarray()}
 
 with col8:
     st.header("Risk by Location")
     try:
-        risk_by_location = df.groupby('location')['claim_risk'].mean().reset_index()
+        risk_by_location = risk_tables['location']
         risk_by_location['claim_risk'] *= 100
         fig_loc = px.bar(risk_by_location, x='location', y='claim_risk', title="Average Risk by Location (%)", color='claim_risk', color_continuous_scale='Blues')
         fig_loc.update_layout(height=300)
@@ -361,7 +540,7 @@ with col8:
 with col9:
     st.header("Risk by Claim Type")
     try:
-        risk_by_claim_type = df.groupby('claim_type')['claim_risk'].mean().reset_index()
+        risk_by_claim_type = risk_tables['claim_type']
         risk_by_claim_type['claim_risk'] *= 100
         fig_claim = px.bar(risk_by_claim_type, x='claim_type', y='claim_risk', title="Average Risk by Claim Type (%)", color='claim_risk', color_continuous_scale='Blues')
         fig_claim.update_layout(height=300)
@@ -394,23 +573,9 @@ with col10:
 
 with col11:
     st.header("Top Features for Segment")
+    shap_segment_slot = st.container()
     try:
-        segment_encoded = pd.get_dummies(segment_data.drop(columns=['claim_amount_SZL', 'claim_risk']), columns=categorical_cols, drop_first=False)
-        for col in expected_features:
-            if col not in segment_encoded.columns:
-                segment_encoded[col] = 0
-        segment_encoded = segment_encoded[expected_features].values
-        shap_values_segment = explainer.shap_values(segment_encoded)
-        if isinstance(shap_values_segment, list):
-            shap_values_segment = shap_values_segment[1]
-        shap_values_segment = np.array(shap_values_segment).reshape(-1, len(expected_features))
-        fig_shap_segment = plt.figure(figsize=(10, 6))
-        shap.summary_plot(shap_values_segment, segment_encoded, feature_names=expected_features, max_display=5, show=False, plot_type="bar")
-        if plt.gcf().axes:
-            plt.title(f'Top Features for {segment}')
-            plt.tight_layout()
-            st.pyplot(fig_shap_segment)
-        logger.info(f"SHAP plot for segment {segment} rendered")
+        shap_inputs['segment'] = encode_features(segment_data, numeric_features, ohe).toarray()
     except Exception as e:
         st.error(f"SHAP plot for segment failed: {str(e)}")
         logger.error(f"SHAP plot for segment failed: {str(e)}")
@@ -423,7 +588,7 @@ with col12:
     regions = st.multiselect("Filter by Region", ['Lubombo', 'Hhohho', 'Manzini', 'Shiselweni'], default=['Lubombo', 'Hhohho', 'Manzini', 'Shiselweni'])
     customer_segments = st.multiselect("Filter by Customer Segment", df['customer_segment'].unique(), default=df['customer_segment'].unique())
     try:
-        m = load_map(df, risk_levels, regions, customer_segments)
+        m = load_map(file_hash, df, risk_levels, regions, customer_segments)
         map_data = st_folium(m, height=500, width=1000, key="eswatini_map")
         selected_region = map_data.get('last_object_clicked_tooltip', '').split(':')[0].strip() if map_data.get('last_object_clicked_tooltip') else None
 
@@ -443,22 +608,9 @@ with col12:
                     fig_region_dist = px.bar(region_data.groupby('claim_risk').size().reset_index(name='Count'), x='claim_risk', y='Count', title=f"Risk Distribution in {selected_region}")
                     fig_region_dist.update_layout(height=300)
                     st.plotly_chart(fig_region_dist, use_container_width=True)
+                shap_region_slot = st.container()
                 sample_region = region_data.sample(min(20, len(region_data)), random_state=42)
-                sample_encoded_region = pd.get_dummies(sample_region.drop(columns=['claim_amount_SZL', 'claim_risk']), columns=categorical_cols, drop_first=False)
-                for col in expected_features:
-                    if col not in sample_encoded_region.columns:
-                        sample_encoded_region[col] = 0
-                sample_encoded_region = sample_encoded_region[expected_features].values
-                shap_values_region = explainer.shap_values(sample_encoded_region)
-                if isinstance(shap_values_region, list):
-                    shap_values_region = shap_values_region[1]
-                shap_values_region = np.array(shap_values_region).reshape(-1, len(expected_features))
-                fig_shap_region = plt.figure(figsize=(10, 6))
-                shap.summary_plot(shap_values_region, sample_encoded_region, feature_names=expected_features, max_display=5, show=False, plot_type="bar")
-                if plt.gcf().axes:
-                    plt.title(f'Top Features for High Risk in {selected_region}')
-                    plt.tight_layout()
-                    st.pyplot(fig_shap_region)
+                shap_inputs['region'] = encode_features(sample_region, numeric_features, ohe).toarray()
             else:
                 st.warning(f"No data available for {selected_region}.")
         logger.info("Interactive map and region analysis rendered")
@@ -466,13 +618,104 @@ with col12:
         st.error(f"Map rendering or analysis failed: {str(e)}")
         logger.error(f"Map rendering or analysis failed: {str(e)}")
 
+# SHAP for the global sample and segment in one batched TreeSHAP pass. The clicked region is only known
+# once the map has returned, so it gets its own small pass and the global + segment entry stays cached.
+shap_outputs = {}
+with st.spinner("Computing SHAP values..."):
+    for batch in (['global', 'segment'], ['region']):
+        batch = [name for name in batch if name in shap_inputs]
+        if not batch:
+            continue
+        try:
+            X_shap = np.vstack([shap_inputs[name] for name in batch])
+            shap_all = compute_shap(explainer, file_hash, X_shap.tobytes(), X_shap.shape)
+            bounds = np.cumsum([0] + [len(shap_inputs[name]) for name in batch])
+            shap_outputs.update({name: shap_all[start:stop] for name, start, stop in zip(batch, bounds[:-1], bounds[1:])})
+        except Exception as e:
+            st.error(f"SHAP computation failed: {str(e)}")
+            logger.error(f"SHAP computation failed: {str(e)}")
+
+if 'global' in shap_outputs:
+    with shap_global_slot:
+        try:
+            sample_encoded, shap_values = shap_inputs['global'], shap_outputs['global']
+            st.subheader("Features Used in SHAP Analysis")
+            st.write(list(expected_features))
+            fig_shap = plt.figure(figsize=(10, 6))
+            shap.summary_plot(shap_values, sample_encoded, feature_names=expected_features, max_display=5, show=False, plot_type="bar")
+            if plt.gcf().axes:
+                plt.title('Top Features for High Risk')
+                plt.tight_layout()
+                st.pyplot(fig_shap)
+                plt.savefig('shap_plot.png')
+            shap_df = pd.DataFrame({'Feature': expected_features, 'SHAP Value': np.abs(shap_values).mean(axis=0)}).sort_values(by='SHAP Value', ascending=False).head(5)
+            st.session_state['shap_df'] = shap_df
+            logger.info("SHAP plot rendered")
+        except Exception as e:
+            st.error(f"SHAP plot failed: {str(e)}")
+            logger.error(f"SHAP plot failed: {str(e)}")
+
+if 'segment' in shap_outputs:
+    with shap_segment_slot:
+        try:
+            segment_encoded, shap_values_segment = shap_inputs['segment'], shap_outputs['segment']
+            fig_shap_segment = plt.figure(figsize=(10, 6))
+            shap.summary_plot(shap_values_segment, segment_encoded, feature_names=expected_features, max_display=5, show=False, plot_type="bar")
+            if plt.gcf().axes:
+                plt.title(f'Top Features for {segment}')
+                plt.tight_layout()
+                st.pyplot(fig_shap_segment)
+            logger.info(f"SHAP plot for segment {segment} rendered")
+        except Exception as e:
+            st.error(f"SHAP plot for segment failed: {str(e)}")
+            logger.error(f"SHAP plot for segment failed: {str(e)}")
+
+if 'region' in shap_outputs:
+    with shap_region_slot:
+        try:
+            sample_encoded_region, shap_values_region = shap_inputs['region'], shap_outputs['region']
+            fig_shap_region = plt.figure(figsize=(10, 6))
+            shap.summary_plot(shap_values_region, sample_encoded_region, feature_names=expected_features, max_display=5, show=False, plot_type="bar")
+            if plt.gcf().axes:
+                plt.title(f'Top Features for High Risk in {selected_region}')
+                plt.tight_layout()
+                st.pyplot(fig_shap_region)
+            logger.info(f"SHAP plot for region {selected_region} rendered")
+        except Exception as e:
+            st.error(f"SHAP plot for region failed: {str(e)}")
+            logger.error(f"SHAP plot for region failed: {str(e)}")
+
 # Section 6: Downloadable Reports and Data
+def build_report_pdf(pdf_path):
+    c = canvas.Canvas(pdf_path, pagesize=letter)
+    _, height = letter
+    y = height - 72
+    c.setFont('Helvetica-Bold', 16)
+    c.drawString(72, y, "Insurance Risk Dashboard Report")
+    c.setFont('Helvetica', 11)
+    for line in [f"Total Policies: {total_policies}", f"% High-Risk Policies: {high_risk_percent:.1f}%", f"Model AUC: {roc_auc:.2f}"]:
+        y -= 18
+        c.drawString(72, y, line)
+    y -= 30
+    c.setFont('Helvetica-Bold', 13)
+    c.drawString(72, y, "Risk by Location")
+    c.setFont('Helvetica', 11)
+    for location, risk, count in zip(risk_by_location['location'], risk_by_location['claim_risk'], risk_by_location['count']):
+        y -= 16
+        if y < 72:
+            c.showPage()
+            c.setFont('Helvetica', 11)
+            y = height - 72
+        c.drawString(72, y, f"{location}: {risk:.1f}% high risk ({count} policies)")
+    c.save()
+
 st.header("Download Reports and Data")
 col13, col14, col15, col16 = st.columns(4)
 with col13:
     st.download_button("Download Cleaned Data", data=df.to_csv(index=False), file_name="cleaned_data.csv")
 with col14:
-    predictions_df = X_test.copy()
+    # Export the readable test rows; the encoded matrix is only for scoring
+    predictions_df = df.iloc[test_idx].drop(columns=['claim_amount_SZL', 'claim_risk'])
     predictions_df['Predicted_Risk'] = y_pred_rf
     st.download_button("Download Predictions", data=predictions_df.to_csv(index=False), file_name="predictions.csv")
 with col15:
@@ -482,21 +725,15 @@ with col15:
         with open('shap_plot.png', 'rb') as f:
             st.download_button("Download SHAP Plot (PNG)", data=f, file_name="shap_plot.png")
 with col16:
-    try:
-        html_content = f"""
-        <h1>Insurance Risk Dashboard Report</h1>
-        <p><strong>Total Policies:</strong> {total_policies}</p>
-        <p><strong>% High-Risk Policies:</strong> {high_risk_percent:.1f}%</p>
-        <p><strong>Model AUC:</strong> {roc_auc:.2f}</p>
-        <h2>Risk by Location</h2>
-        {risk_by_location.to_html()}
-        """
-        weasyprint.HTML(string=html_content).write_pdf('report.pdf')
-        with open('report.pdf', 'rb') as f:
-            st.download_button("Download Full Report (PDF)", data=f, file_name="report.pdf")
-    except Exception as e:
-        st.warning(f"PDF generation failed: {str(e)}. Ensure WeasyPrint is installed and configured.")
-        logger.error(f"PDF generation failed: {str(e)}")
+    if st.button("Generate Report"):
+        try:
+            build_report_pdf('report.pdf')
+            with open('report.pdf', 'rb') as f:
+                st.download_button("Download Full Report (PDF)", data=f, file_name="report.pdf")
+            logger.info("PDF report generated")
+        except Exception as e:
+            st.warning(f"PDF generation failed: {str(e)}")
+            logger.error(f"PDF generation failed: {str(e)}")
 
 # Notes
 st.markdown("**Note**: Ensure the dataset is available. Risk map uses claim risk data to highlight high-risk areas.", unsafe_allow_html=True)